@@ -0,0 +1,2 @@
+# test_imports.py is a diagnostic script for the Docker image, not a test module
+collect_ignore = ["test_imports.py"]
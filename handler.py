@@ -2,16 +2,37 @@
 RunPod Serverless Handler for Hallo3
 Generates talking-head videos from image + audio inputs
 
-Models are downloaded at runtime on first request and cached on network volume.
+Models are downloaded and loaded when the worker starts and cached on network volume.
+Set PRELOAD_MODELS=0 to only download in the background and load on first request.
 """
 
 import os
+import re
+import shutil
 import sys
-import base64
+import asyncio
+import contextlib
+import errno
+import importlib
+import importlib.util
+import mmap
 import uuid
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import base64
+
+try:
+    # SIMD-accelerated codec that releases the GIL, same API as base64
+    import pybase64
+except ImportError:
+    pybase64 = None
+
+# Codec used for the payloads: pybase64 when installed, else the stdlib
+b64codec = pybase64 or base64
+
 import runpod
 
 # Add hallo3 paths for imports
@@ -22,78 +43,142 @@ sys.path.insert(0, str(HALLO3_MODULE_PATH))  # Add hallo3/hallo3 for local impor
 
 # Network volume for persistent model storage (survives rebuilds)
 VOLUME_PATH = Path("/runpod-volume")
-MODELS_CACHE = VOLUME_PATH / "hallo3-models"
+HF_CACHE = VOLUME_PATH / "hf-cache"
+COMPILE_CACHE = VOLUME_PATH / "compile-cache"
+# Earlier layout: a plain copy of the snapshot, marked complete by .download_complete
+LEGACY_MODELS_DIR = VOLUME_PATH / "hallo3-models" / "pretrained_models"
+
+# Keep the standard HF cache layout on the network volume so snapshots are
+# content-addressed, resumable and shared across pods without copying, and
+# use the Rust-based hf_transfer backend for parallel chunked downloads when
+# it is installed (huggingface_hub refuses to download if enabled but missing).
+# huggingface_hub reads both when it is imported, which transformers/diffusers
+# do as well, so they are set before anything can import it.
+if VOLUME_PATH.exists():
+    os.environ["HF_HOME"] = str(HF_CACHE)
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
+# Chunk sizes for streaming base64 (64 KiB blocks of raw bytes)
+B64_ENCODE_CHUNK = 3 * 64 * 1024  # bytes, multiple of 3
+B64_DECODE_CHUNK = 4 * 64 * 1024  # base64 characters, multiple of 4
+
+# RAM-backed directory for input temp files (falls back to the default temp dir)
+RAM_TEMP_DIR = "/dev/shm"
+
+# S3-compatible bucket for returning videos by URL instead of base64
+BUCKET_NAME = os.environ.get("BUCKET_NAME")
+BUCKET_ENDPOINT_URL = os.environ.get("BUCKET_ENDPOINT_URL")
+PRESIGNED_URL_EXPIRY = int(os.environ.get("PRESIGNED_URL_EXPIRY", "3600"))
+
+# Heavy modules imported in the background while models download
+PREIMPORT_MODULES = ["torch", "transformers", "diffusers", "insightface", "sat"]
+
+# Weight files prefetched into the page cache at load time
+WEIGHT_SUFFIXES = {".safetensors", ".pt", ".pth", ".bin", ".onnx"}
+PREFETCH_STRIDE = 2 * 1024 * 1024
+
+# Where VideoGenerator keeps the diffusion transformer: the SAT engine
+# (CogVideoX-5b) or a diffusers pipeline
+TRANSFORMER_ATTRS = [
+    "model.model.diffusion_model",
+    "model.diffusion_model",
+    "pipeline.transformer",
+]
+
+# Jobs accepted concurrently; generation itself is serialized on the GPU
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "1"))
+
+# Diffusion transformer weight quantization: int8, fp8, or off (unset/empty/0).
+# Checked here so a bad value fails the worker at start, not after a model load
+QUANTIZE = os.environ.get("QUANTIZE", "").strip().lower()
+if QUANTIZE in ("", "0"):
+    QUANTIZE = None
+elif QUANTIZE not in ("int8", "fp8"):
+    raise ValueError(f"Unsupported QUANTIZE value: {QUANTIZE} (expected int8, fp8 or 0)")
 
 # Global generator instance (loaded once, reused)
 generator = None
 models_downloaded = False
+download_lock = threading.Lock()
+generator_lock = threading.Lock()
+
+# S3 client shared by all jobs (created on first upload)
+s3_client = None
+s3_client_lock = threading.Lock()
+
+# Model loading, warm-up and every generation run on this one thread: it
+# serializes jobs on the GPU, and the CUDA graphs torch.compile records in
+# reduce-overhead mode are per thread, so warm-up is only reused on the same one
+gpu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu")
 
 
 def download_models():
     """Download Hallo3 models from HuggingFace (cached on network volume)"""
     global models_downloaded
-    if models_downloaded:
-        return
+    with download_lock:
+        if models_downloaded:
+            return
 
-    from huggingface_hub import snapshot_download
+        hallo3_models = HALLO3_PATH / "pretrained_models"
 
-    # Use network volume if available, otherwise fall back to workspace
-    if VOLUME_PATH.exists():
-        models_dir = MODELS_CACHE / "pretrained_models"
-        print(f"Using network volume for model storage: {models_dir}")
-    else:
-        models_dir = HALLO3_PATH / "pretrained_models"
-        print(f"Network volume not found, using workspace: {models_dir}")
+        # Models baked into the image (runpod.toml build) need no download
+        if hallo3_models.is_dir() and not hallo3_models.is_symlink():
+            print(f"Using models from the image: {hallo3_models}")
+            models_downloaded = True
+            return
 
-    models_dir.mkdir(parents=True, exist_ok=True)
+        # Volumes filled before models moved to the HuggingFace cache keep working
+        if (LEGACY_MODELS_DIR / ".download_complete").exists():
+            print(f"Using models from previous volume layout: {LEGACY_MODELS_DIR}")
+            link_pretrained_models(LEGACY_MODELS_DIR)
+            models_downloaded = True
+            return
 
-    # Create symlink from hallo3/pretrained_models to the models location
-    hallo3_models = HALLO3_PATH / "pretrained_models"
-    if not hallo3_models.exists() and VOLUME_PATH.exists():
-        hallo3_models.symlink_to(models_dir)
-        print(f"Created symlink: {hallo3_models} -> {models_dir}")
+        if VOLUME_PATH.exists():
+            print(f"Using network volume for HuggingFace cache: {HF_CACHE}")
+        else:
+            print("Network volume not found, using default HuggingFace cache")
+
+        from huggingface_hub import snapshot_download
 
-    # Check if models already exist on volume
-    marker_file = models_dir / ".download_complete"
-    if marker_file.exists():
         print("=" * 60)
-        print("MODELS FOUND ON NETWORK VOLUME - SKIPPING DOWNLOAD")
+        print("FETCHING HALLO3 MODELS")
+        print("Files already in the HuggingFace cache are not downloaded again")
+        print("A first download may take 10-20 minutes (~70GB of models)")
         print("=" * 60)
-        models_downloaded = True
-        return
 
-    print("=" * 60)
-    print("DOWNLOADING HALLO3 MODELS (first request only)")
-    print("Models will be cached on network volume for future builds")
-    print("This may take 10-20 minutes (~70GB of models)")
-    print("=" * 60)
-
-    # The fudan-generative-ai/hallo3 HuggingFace repo contains ALL required models:
-    # - hallo3/ (main checkpoint)
-    # - cogvideox-5b-i2v-sat/ (video VAE)
-    # - t5-v1_1-xxl/ (text encoder)
-    # - wav2vec/ (audio encoder)
-    # - face_analysis/ (InsightFace models)
-    # - audio_separator/ (vocal separation)
-    #
-    # Download directly to pretrained_models so paths match config expectations
-    print("\nDownloading all Hallo3 models from fudan-generative-ai/hallo3...")
-    snapshot_download(
-        repo_id="fudan-generative-ai/hallo3",
-        local_dir=str(models_dir),
-        local_dir_use_symlinks=False
-    )
+        # The fudan-generative-ai/hallo3 HuggingFace repo contains ALL required models:
+        # - hallo3/ (main checkpoint)
+        # - cogvideox-5b-i2v-sat/ (video VAE)
+        # - t5-v1_1-xxl/ (text encoder)
+        # - wav2vec/ (audio encoder)
+        # - face_analysis/ (InsightFace models)
+        # - audio_separator/ (vocal separation)
+        #
+        # Everything lives in one repo, so concurrency comes from fetching its files
+        # in parallel (max_workers) rather than from running several downloads.
+        snapshot_path = snapshot_download(
+            repo_id="fudan-generative-ai/hallo3",
+            max_workers=8,
+            etag_timeout=30
+        )
+        print(f"Models available at: {snapshot_path}")
+        link_pretrained_models(snapshot_path)
 
-    print("All models downloaded successfully")
+        models_downloaded = True
+        print("\n" + "=" * 60)
+        print("MODELS READY")
+        print("=" * 60 + "\n")
 
-    # Create marker file to indicate download is complete
-    marker_file.touch()
-    print(f"Created marker file: {marker_file}")
 
-    models_downloaded = True
-    print("\n" + "=" * 60)
-    print("MODEL DOWNLOAD COMPLETE - CACHED ON NETWORK VOLUME")
-    print("=" * 60 + "\n")
+def link_pretrained_models(models_dir):
+    """Symlink hallo3/pretrained_models to models_dir so Hallo3's relative config paths resolve"""
+    hallo3_models = HALLO3_PATH / "pretrained_models"
+    if hallo3_models.is_symlink():
+        hallo3_models.unlink()
+    hallo3_models.symlink_to(models_dir, target_is_directory=True)
+    print(f"Created symlink: {hallo3_models} -> {models_dir}")
 
 
 def load_generator():
@@ -102,50 +187,379 @@ def load_generator():
     if generator is not None:
         return generator
 
+    # Concurrent jobs arriving before the worker is warm must not load twice
+    with generator_lock:
+        if generator is None:
+            generator = gpu_executor.submit(build_generator).result()
+    return generator
+
+
+def build_generator():
+    """Download models and construct the Hallo3 VideoGenerator"""
+    # Import heavy dependencies while models download
+    import_thread = threading.Thread(target=preimport_modules, daemon=True)
+    import_thread.start()
+
     # Download models first (if not already done)
     download_models()
+    import_thread.join()
+
+    # Pull weights into the page cache while the generator is being built
+    if os.environ.get("PREFETCH_WEIGHTS", "1") == "1":
+        threading.Thread(
+            target=prefetch_weights, args=(HALLO3_PATH / "pretrained_models",), daemon=True
+        ).start()
 
     print("Loading Hallo3 VideoGenerator...")
 
     # Change to hallo3 root directory (where ./configs/ lives)
-    # The app.py uses relative paths like "./configs/cogvideox_5b_i2v_s2.yaml"
+    # The app.py uses relative paths like "./configs/cogvideox_5b_i2v_s2.yaml",
+    # and that yaml in turn points at "./pretrained_models/...", so passing an
+    # absolute config path is not enough. This happens once, before any job
+    # runs, and the handler itself only uses absolute paths, so concurrent
+    # jobs never depend on the working directory.
     os.chdir(HALLO3_PATH)
     print(f"Working directory: {os.getcwd()}")
 
     from app import VideoGenerator
-    generator = VideoGenerator()
+    gen = VideoGenerator()
+
+    if QUANTIZE:
+        quantize_transformer(gen, QUANTIZE)
+
+    if os.environ.get("TORCH_COMPILE") == "1":
+        compile_transformer(gen)
+        warm_up(gen)
 
     print("Hallo3 VideoGenerator loaded successfully")
-    return generator
+    return gen
+
+
+def preimport_modules():
+    """Import Hallo3's heavy dependencies ahead of VideoGenerator"""
+    # Sequential on purpose: they share torch, and parallel imports of the
+    # same packages only contend on the import locks
+    for name in PREIMPORT_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print(f"Failed to preimport {name}: {e}")
+
+
+def prefetch_weights(models_dir: Path):
+    """Ask the kernel to read weight files into the page cache ahead of model loading"""
+    for path in sorted(models_dir.rglob("*")):
+        if path.suffix not in WEIGHT_SUFFIXES or not path.is_file():
+            continue
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            size = os.fstat(fd).st_size
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            # Touch every 2 MiB for filesystems that ignore the advice (e.g. network volumes)
+            for offset in range(0, size, PREFETCH_STRIDE):
+                os.pread(fd, 4096, offset)
+        except OSError as e:
+            print(f"Failed to prefetch {path}: {e}")
+        finally:
+            os.close(fd)
+    print("Weight prefetch complete")
+
+
+def find_module(gen, attr_paths):
+    """Return the first module found along the given dotted attribute paths"""
+    for attr_path in attr_paths:
+        module = gen
+        for attr in attr_path.split("."):
+            module = getattr(module, attr, None)
+            if module is None:
+                break
+        if module is not None:
+            return module
+    return None
+
+
+def quantize_transformer(gen, weights: str):
+    """Quantize the diffusion transformer weights to int8 or fp8 with optimum-quanto"""
+    from optimum.quanto import freeze, qfloat8, qint8, quantize
+
+    qtypes = {"int8": qint8, "fp8": qfloat8}
+
+    transformer = find_module(gen, TRANSFORMER_ATTRS)
+    if transformer is None:
+        print("Diffusion transformer not found, skipping quantization")
+        return
 
+    # VAE and text encoder stay in fp16, they run once per segment
+    print(f"Quantizing {type(transformer).__name__} weights to {weights}...")
+    quantize(transformer, weights=qtypes[weights])
+    freeze(transformer)
 
-def decode_base64_to_file(base64_data: str, suffix: str) -> str:
-    """Decode base64 string to a temporary file"""
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-    temp_file.write(base64.b64decode(base64_data))
-    temp_file.close()
+
+def configure_compile_cache():
+    """Persist Inductor/Triton compile artifacts on the network volume"""
+    import torch
+    import torch._inductor.config as inductor_config
+
+    if not VOLUME_PATH.exists():
+        return
+
+    # Generated kernels are specific to the GPU architecture and torch build
+    device_name = torch.cuda.get_device_name(0) if torch.cuda.is_available() else "cpu"
+    key = re.sub(r"[^A-Za-z0-9.]+", "-", f"{device_name}-torch{torch.__version__}")
+    cache_dir = COMPILE_CACHE / key
+
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = str(cache_dir)
+    os.environ["TRITON_CACHE_DIR"] = str(cache_dir / "triton")
+    inductor_config.fx_graph_cache = True
+    print(f"Using compile cache: {cache_dir}")
+
+
+def compile_transformer(gen):
+    """Compile the diffusion transformer in place with torch.compile"""
+    transformer = find_module(gen, TRANSFORMER_ATTRS)
+    if transformer is None:
+        print("Diffusion transformer not found, skipping torch.compile")
+        return
+
+    import torch._dynamo
+
+    configure_compile_cache()
+
+    # Dynamo keeps one specialized graph per input shape behind its guards;
+    # leave room for every shape Hallo3 produces so none is evicted or
+    # falls back to eager
+    cache_size_limit = int(os.environ.get("DYNAMO_CACHE_SIZE_LIMIT", "32"))
+    torch._dynamo.config.cache_size_limit = max(
+        torch._dynamo.config.cache_size_limit, cache_size_limit
+    )
+
+    mode = os.environ.get("TORCH_COMPILE_MODE", "reduce-overhead")
+    print(f"Compiling {type(transformer).__name__} with torch.compile (mode={mode})...")
+    transformer.compile(mode=mode, fullgraph=False, dynamic=False)
+
+
+def attention_backend():
+    """Context restricting scaled_dot_product_attention to fused kernels (FLASH_ATTENTION=1)"""
+    if os.environ.get("FLASH_ATTENTION") != "1":
+        return contextlib.nullcontext()
+
+    from torch.nn.attention import SDPBackend, sdpa_kernel
+
+    # No math fallback: never materialize the full attention matrix
+    return sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION])
+
+
+def generate_video(gen, image_path: str, audio_path: str, prompt: str) -> str:
+    """Generate a video and return its absolute path (runs on gpu_executor)"""
+    with attention_backend():
+        output_path = gen.generate_video(
+            image=image_path,
+            audio_file=audio_path,
+            prompt=prompt
+        )
+    return os.path.abspath(output_path)
+
+
+def warm_up(gen):
+    """Run generations on WARMUP_IMAGE/WARMUP_AUDIO to pay compile cost at worker start"""
+    image_path = os.environ.get("WARMUP_IMAGE")
+    audio_paths = os.environ.get("WARMUP_AUDIO")
+    if not (image_path and audio_paths):
+        print("WARMUP_IMAGE/WARMUP_AUDIO not set, compilation will happen on the first job")
+        return
+
+    # One clip per audio length in production, so each input shape is compiled.
+    # Warm-up is only an optimization: a failing clip must not discard the
+    # loaded generator, the job using that shape just compiles it instead
+    for audio_path in audio_paths.split(os.pathsep):
+        print(f"Warming up with {image_path} + {audio_path}...")
+        try:
+            output_path = generate_video(gen, image_path, audio_path, "A person talking naturally")
+        except Exception as e:
+            print(f"Warm-up with {audio_path} failed: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            continue
+        if os.path.exists(output_path):
+            os.remove(output_path)
+    print("Warm-up complete")
+
+
+def temp_dir_for(size: int):
+    """Return /dev/shm if it is writable and has room for `size` bytes, else None"""
+    if not os.access(RAM_TEMP_DIR, os.W_OK):
+        return None
+    # Keep headroom: /dev/shm is often small (64 MB by default in Docker)
+    if shutil.disk_usage(RAM_TEMP_DIR).free < 2 * size:
+        return None
+    return str(RAM_TEMP_DIR)
+
+
+def create_temp_file(write, suffix: str, temp_dir) -> str:
+    """Create a temporary file filled by write(file), removing it again if writing fails"""
+    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=temp_dir)
+    try:
+        with temp_file:
+            write(temp_file)
+    except BaseException:
+        os.unlink(temp_file.name)
+        raise
     return temp_file.name
 
 
+def write_temp_file(write, suffix: str, size: int) -> str:
+    """Create a temporary file filled by write(file), in /dev/shm when it has room"""
+    temp_dir = temp_dir_for(size) if size else None
+    try:
+        return create_temp_file(write, suffix, temp_dir)
+    except OSError as e:
+        # Free space was checked up front, but concurrent writes can still fill it
+        if temp_dir is None or e.errno != errno.ENOSPC:
+            raise
+        print(f"{temp_dir} is full, retrying in the default temp dir")
+        return create_temp_file(write, suffix, None)
+
+
+def decode_base64_to_file(base64_data: str, suffix: str) -> str:
+    """Decode base64 string to a temporary file, one chunk at a time"""
+    def write(temp_file):
+        # Input may be line-wrapped (e.g. base64.encodebytes), so drop whitespace
+        # and carry any characters past the last full 4-character group over to
+        # the next slice; only the final group can hold padding
+        pending = ""
+        for start in range(0, len(base64_data), B64_DECODE_CHUNK):
+            pending += "".join(base64_data[start:start + B64_DECODE_CHUNK].split())
+            usable = len(pending) - len(pending) % 4
+            temp_file.write(b64codec.b64decode(pending[:usable]))
+            pending = pending[usable:]
+        if pending:
+            temp_file.write(b64codec.b64decode(pending))
+
+    return write_temp_file(write, suffix, len(base64_data) * 3 // 4)
+
+
 def encode_file_to_base64(file_path: str) -> str:
-    """Encode a file to base64 string"""
+    """Encode a file to base64 string, one chunk at a time from a memory map"""
+    encoded = bytearray()
     with open(file_path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        # Pages are read on demand; the raw file is never copied into Python
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            # Chunks are a multiple of 3 bytes, so only the last one gets padding
+            for start in range(0, len(view), B64_ENCODE_CHUNK):
+                encoded += b64codec.b64encode(view[start:start + B64_ENCODE_CHUNK])
+    return encoded.decode("ascii")
+
+
+def download_url_to_file(url: str, suffix: str) -> str:
+    """Stream a remote file to a temporary file"""
+    import requests
+
+    first_response = requests.get(url, stream=True, timeout=60)
+    response = first_response
+    try:
+        # Fail before creating any file
+        first_response.raise_for_status()
+        # Without a Content-Length the size is unknown, so stay on disk
+        size = int(first_response.headers.get("Content-Length", 0))
+
+        def write(temp_file):
+            nonlocal response
+            # A retry in another directory needs a fresh stream
+            if response is None:
+                response = requests.get(url, stream=True, timeout=60)
+            current, response = response, None
+            with current:
+                current.raise_for_status()
+                for chunk in current.iter_content(chunk_size=1024 * 1024):
+                    temp_file.write(chunk)
+
+        return write_temp_file(write, suffix, size)
+    finally:
+        first_response.close()
+
+
+def fetch_input_file(job_input: dict, name: str, suffix: str) -> str:
+    """Write a job input given as base64 (`name`) or URL (`name_url`) to a temp file"""
+    if name in job_input:
+        return decode_base64_to_file(job_input[name], suffix)
+    return download_url_to_file(job_input[f"{name}_url"], suffix)
+
+
+def get_s3_client():
+    """Return the shared S3 client, creating it on first use"""
+    global s3_client
+    # boto3's default session is not thread-safe, but a built client is
+    with s3_client_lock:
+        if s3_client is None:
+            import boto3
+
+            s3_client = boto3.session.Session().client(
+                "s3",
+                endpoint_url=BUCKET_ENDPOINT_URL,
+                aws_access_key_id=os.environ.get("BUCKET_ACCESS_KEY_ID"),
+                aws_secret_access_key=os.environ.get("BUCKET_SECRET_ACCESS_KEY")
+            )
+    return s3_client
+
+
+def upload_video(file_path: str) -> str:
+    """Upload a video to the configured bucket and return a presigned URL"""
+    from boto3.s3.transfer import TransferConfig
+
+    s3 = get_s3_client()
+    key = f"hallo3/{uuid.uuid4()}.mp4"
+
+    # Parallel multipart upload straight from disk
+    s3.upload_file(
+        file_path,
+        BUCKET_NAME,
+        key,
+        ExtraArgs={"ContentType": "video/mp4"},
+        Config=TransferConfig(multipart_chunksize=16 * 1024 * 1024, max_concurrency=8)
+    )
+    return s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": BUCKET_NAME, "Key": key},
+        ExpiresIn=PRESIGNED_URL_EXPIRY
+    )
+
+
+def cleanup_files(paths):
+    """Remove temporary files, ignoring ones that are already gone"""
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Failed to remove {path}: {e}")
 
 
-def handler(job):
+def process_job(job):
     """
-    RunPod serverless handler for Hallo3 video generation
+    Hallo3 video generation for a single job
 
     Input:
         {
-            "image": "base64_encoded_png",
-            "audio": "base64_encoded_wav",
+            "image": "base64_encoded_png",      # or "image_url": "https://..."
+            "audio": "base64_encoded_wav",      # or "audio_url": "https://..."
             "prompt": "optional text description",
-            "driving_video": "optional base64_encoded_mp4"
+            "driving_video": "optional base64_encoded_mp4",
+            "return_base64": false              # optional, force base64 output
         }
 
-    Output:
+    Output (when BUCKET_NAME is configured):
+        {
+            "video_url": "presigned_url_to_mp4",
+            "expires_in": 3600
+        }
+
+    Output (otherwise, or with return_base64):
         {
             "video": "base64_encoded_mp4"
         }
@@ -153,51 +567,54 @@ def handler(job):
     job_input = job["input"]
 
     # Validate required inputs
-    if "image" not in job_input:
-        return {"error": "Missing required input: image"}
-    if "audio" not in job_input:
-        return {"error": "Missing required input: audio"}
+    if "image" not in job_input and "image_url" not in job_input:
+        return {"error": "Missing required input: image or image_url"}
+    if "audio" not in job_input and "audio_url" not in job_input:
+        return {"error": "Missing required input: audio or audio_url"}
 
     temp_files = []
 
     try:
-        # Load generator (cached after first call)
-        gen = load_generator()
-
-        # Decode image from base64
-        print("Decoding input image...")
-        image_path = decode_base64_to_file(job_input["image"], ".png")
-        temp_files.append(image_path)
-
-        # Decode audio from base64
-        print("Decoding input audio...")
-        audio_path = decode_base64_to_file(job_input["audio"], ".wav")
-        temp_files.append(audio_path)
+        # Decode (or download) image and audio in parallel while the
+        # generator is loaded (cached after first call). Audio has to stay a
+        # file: Hallo3 runs vocal separation on the path before wav2vec, so it
+        # cannot take a decoded waveform.
+        print("Fetching input image and audio...")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            image_future = executor.submit(fetch_input_file, job_input, "image", ".png")
+            audio_future = executor.submit(fetch_input_file, job_input, "audio", ".wav")
+            try:
+                gen = load_generator()
+            finally:
+                # Track whatever was written so it is cleaned up on any failure
+                for future in (image_future, audio_future):
+                    if future.exception() is None:
+                        temp_files.append(future.result())
+        image_path = image_future.result()
+        audio_path = audio_future.result()
 
         # Get optional prompt
         prompt = job_input.get("prompt", "A person talking naturally")
 
-        # Load image
-        from PIL import Image
-        image = Image.open(image_path)
-
         # Note: driving_video is not directly supported by Hallo3's current API
         # The model generates motion automatically from audio
         if "driving_video" in job_input:
             print("Note: driving_video provided but Hallo3 generates motion from audio")
 
-        # Generate video
+        # Generate video (one job at a time on the GPU thread)
         print(f"Generating video with prompt: {prompt}")
-        output_path = gen.generate_video(
-            image=image,
-            audio_file=audio_path,
-            prompt=prompt
-        )
+        output_path = gpu_executor.submit(
+            generate_video, gen, image_path, audio_path, prompt
+        ).result()
         temp_files.append(output_path)
 
         print(f"Video generated: {output_path}")
 
-        # Encode output video to base64
+        # Upload output video to the bucket, or fall back to base64
+        if BUCKET_NAME and not job_input.get("return_base64", False):
+            video_url = upload_video(output_path)
+            return {"video_url": video_url, "expires_in": PRESIGNED_URL_EXPIRY}
+
         video_base64 = encode_file_to_base64(output_path)
 
         return {"video": video_base64}
@@ -209,14 +626,40 @@ def handler(job):
         return {"error": str(e)}
 
     finally:
-        # Cleanup temp files
-        for temp_file in temp_files:
-            try:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
-            except Exception:
-                pass
+        # Cleanup temp files off the response path
+        threading.Thread(target=cleanup_files, args=(temp_files,), daemon=True).start()
+
+
+async def handler(job):
+    """
+    RunPod serverless handler for Hallo3 video generation
 
+    Jobs run in worker threads so that, with MAX_CONCURRENCY > 1, one job's
+    input download/decode and output upload overlap another job's generation.
+    """
+    return await asyncio.to_thread(process_job, job)
+
+
+def concurrency_modifier(current_concurrency):
+    """Number of jobs this worker accepts at once"""
+    return MAX_CONCURRENCY
+
+
+if __name__ == "__main__":
+    # Warm up at worker start so the first job only pays for inference
+    if os.environ.get("PRELOAD_MODELS", "1") == "1":
+        try:
+            load_generator()
+        except Exception as e:
+            # Leave the worker up; the first job retries loading and reports the error
+            print(f"Error preloading models: {str(e)}")
+            import traceback
+            traceback.print_exc()
+    else:
+        threading.Thread(target=download_models, daemon=True).start()
 
-# Start RunPod serverless worker
-runpod.serverless.start({"handler": handler})
+    # Start RunPod serverless worker
+    runpod.serverless.start({
+        "handler": handler,
+        "concurrency_modifier": concurrency_modifier
+    })
@@ -0,0 +1,330 @@
+"""
+Tests for the handler's input/output helpers (base64, temp files, URL
+downloads, bucket uploads), warm-up and model download selection.
+
+Usage: python -m pytest test_handler.py
+"""
+
+import base64
+import binascii
+import errno
+import os
+import sys
+import tempfile
+import types
+
+import pytest
+
+# The helpers don't need the RunPod SDK; stub it when it isn't installed
+try:
+    import runpod  # noqa: F401
+except ImportError:
+    sys.modules["runpod"] = types.ModuleType("runpod")
+
+import handler
+
+try:
+    import pybase64
+except ImportError:
+    pybase64 = None
+
+# Sizes around the streaming chunk boundaries
+SIZES = [0, 1, 2, 3, 196607, 196608, 196609, 1000003]
+
+# Every codec the handler can run with here
+CODECS = [
+    base64,
+    pytest.param(pybase64, marks=pytest.mark.skipif(pybase64 is None, reason="pybase64 not installed")),
+]
+
+
+@pytest.fixture(params=CODECS, ids=["base64", "pybase64"])
+def codec(request, monkeypatch):
+    monkeypatch.setattr(handler, "b64codec", request.param)
+    return request.param
+
+
+def round_trip(encoded: str) -> bytes:
+    path = handler.decode_base64_to_file(encoded, ".bin")
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_decode_plain_base64(size, codec):
+    data = os.urandom(size)
+    assert round_trip(base64.b64encode(data).decode()) == data
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_decode_line_wrapped_base64(size, codec):
+    data = os.urandom(size)
+    assert round_trip(base64.encodebytes(data).decode()) == data
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_encode_file_to_base64(size, codec, tmp_path):
+    data = os.urandom(size)
+    path = tmp_path / "video.mp4"
+    path.write_bytes(data)
+    assert handler.encode_file_to_base64(str(path)) == base64.b64encode(data).decode()
+
+
+def test_failed_decode_removes_temp_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(handler, "temp_dir_for", lambda size: str(tmp_path))
+    with pytest.raises(binascii.Error):
+        handler.decode_base64_to_file(base64.b64encode(os.urandom(300000)).decode() + "A", ".wav")
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_full_ram_dir_falls_back_to_default_temp_dir(tmp_path, monkeypatch):
+    ram_dir = tmp_path / "shm"
+    disk_dir = tmp_path / "tmp"
+    ram_dir.mkdir()
+    disk_dir.mkdir()
+    monkeypatch.setattr(handler, "temp_dir_for", lambda size: str(ram_dir))
+    monkeypatch.setattr(tempfile, "tempdir", str(disk_dir))
+
+    def write(temp_file):
+        if os.path.dirname(temp_file.name) == str(ram_dir):
+            raise OSError(errno.ENOSPC, "No space left on device")
+        temp_file.write(b"data")
+
+    path = handler.write_temp_file(write, ".wav", 4)
+    assert os.path.dirname(path) == str(disk_dir)
+    assert list(ram_dir.iterdir()) == []
+
+
+class FakeResponse:
+    """Minimal streamed requests.Response"""
+
+    def __init__(self, status_code=200, body=b"", headers=None, error=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {"Content-Length": str(len(body))}
+        self.error = error
+        self.closed = False
+
+    def __bool__(self):
+        # Like requests: error responses are falsy
+        return self.status_code < 400
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.closed = True
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def iter_content(self, chunk_size):
+        if self.error:
+            raise self.error
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+
+@pytest.fixture
+def fake_get(monkeypatch):
+    """Stub requests.get to return queued FakeResponses, recording each one"""
+    queued, returned = [], []
+
+    def get(url, stream, timeout):
+        response = queued.pop(0)
+        returned.append(response)
+        return response
+
+    monkeypatch.setitem(sys.modules, "requests", types.SimpleNamespace(get=get))
+    return queued, returned
+
+
+def test_download_url_to_file(tmp_path, monkeypatch, fake_get):
+    queued, returned = fake_get
+    monkeypatch.setattr(handler, "temp_dir_for", lambda size: str(tmp_path))
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    queued.append(FakeResponse(body=data))
+
+    path = handler.download_url_to_file("https://example.com/a.wav", ".wav")
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert len(returned) == 1 and returned[0].closed
+
+
+def test_download_url_error_is_fetched_once_and_closed(tmp_path, monkeypatch, fake_get):
+    queued, returned = fake_get
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    queued.append(FakeResponse(status_code=404, headers={}))
+
+    with pytest.raises(RuntimeError):
+        handler.download_url_to_file("https://example.com/missing.wav", ".wav")
+    assert len(returned) == 1 and returned[0].closed
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_download_url_retries_in_default_temp_dir_when_ram_dir_is_full(tmp_path, monkeypatch, fake_get):
+    queued, returned = fake_get
+    ram_dir = tmp_path / "shm"
+    disk_dir = tmp_path / "tmp"
+    ram_dir.mkdir()
+    disk_dir.mkdir()
+    monkeypatch.setattr(handler, "temp_dir_for", lambda size: str(ram_dir))
+    monkeypatch.setattr(tempfile, "tempdir", str(disk_dir))
+    data = os.urandom(1000)
+    queued.append(FakeResponse(body=data, error=OSError(errno.ENOSPC, "No space left on device")))
+    queued.append(FakeResponse(body=data))
+
+    path = handler.download_url_to_file("https://example.com/a.wav", ".wav")
+    assert os.path.dirname(path) == str(disk_dir)
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert list(ram_dir.iterdir()) == []
+    assert len(returned) == 2 and all(response.closed for response in returned)
+
+
+class FakeS3Client:
+    """Records uploads and hands out fake presigned URLs"""
+
+    def __init__(self):
+        self.uploads = {}
+
+    def upload_file(self, file_path, bucket, key, ExtraArgs, Config):
+        with open(file_path, "rb") as f:
+            self.uploads[(bucket, key)] = f.read()
+
+    def generate_presigned_url(self, method, Params, ExpiresIn):
+        return f"https://{Params['Bucket']}.example.com/{Params['Key']}?expires={ExpiresIn}"
+
+
+class FakeGenerator:
+    """Writes a fixed video instead of running Hallo3"""
+
+    def __init__(self, output_dir, video):
+        self.output_dir = output_dir
+        self.video = video
+
+    def generate_video(self, image, audio_file, prompt):
+        output_path = self.output_dir / "output.mp4"
+        output_path.write_bytes(self.video)
+        return str(output_path)
+
+
+@pytest.fixture
+def fake_bucket(tmp_path, monkeypatch):
+    """Configure a bucket with a stub S3 client and a fake generator"""
+    s3 = FakeS3Client()
+    video = os.urandom(5000)
+    transfer = types.SimpleNamespace(TransferConfig=lambda **kwargs: kwargs)
+    monkeypatch.setitem(sys.modules, "boto3", types.SimpleNamespace())
+    monkeypatch.setitem(sys.modules, "boto3.s3", types.SimpleNamespace(transfer=transfer))
+    monkeypatch.setitem(sys.modules, "boto3.s3.transfer", transfer)
+    monkeypatch.setattr(handler, "get_s3_client", lambda: s3)
+    monkeypatch.setattr(handler, "BUCKET_NAME", "videos")
+    monkeypatch.setattr(handler, "generator", FakeGenerator(tmp_path, video))
+    return s3, video
+
+
+JOB_INPUT = {
+    "image": base64.b64encode(b"png").decode(),
+    "audio": base64.b64encode(b"wav").decode(),
+}
+
+
+def test_job_returns_presigned_url_when_bucket_is_configured(fake_bucket):
+    s3, video = fake_bucket
+
+    result = handler.process_job({"input": dict(JOB_INPUT)})
+    assert set(result) == {"video_url", "expires_in"}
+    assert result["expires_in"] == handler.PRESIGNED_URL_EXPIRY
+    [(bucket, key)] = s3.uploads
+    assert bucket == "videos"
+    assert key in result["video_url"]
+    assert s3.uploads[(bucket, key)] == video
+
+
+def test_job_returns_base64_when_requested(fake_bucket):
+    s3, video = fake_bucket
+
+    result = handler.process_job({"input": dict(JOB_INPUT, return_base64=True)})
+    assert result == {"video": base64.b64encode(video).decode()}
+    assert s3.uploads == {}
+
+
+def test_failed_warm_up_clip_does_not_stop_the_others(tmp_path, monkeypatch):
+    generated = []
+
+    class FlakyGenerator:
+        def generate_video(self, image, audio_file, prompt):
+            if audio_file == "missing.wav":
+                raise FileNotFoundError(audio_file)
+            generated.append(audio_file)
+            output_path = tmp_path / "warmup.mp4"
+            output_path.write_bytes(b"mp4")
+            return str(output_path)
+
+    monkeypatch.setenv("WARMUP_IMAGE", "face.png")
+    monkeypatch.setenv("WARMUP_AUDIO", os.pathsep.join(["missing.wav", "short.wav"]))
+
+    handler.warm_up(FlakyGenerator())
+    assert generated == ["short.wav"]
+    assert not (tmp_path / "warmup.mp4").exists()
+
+
+@pytest.fixture
+def model_dirs(tmp_path, monkeypatch):
+    """Point the handler at empty hallo3/legacy dirs and stub snapshot_download"""
+    hallo3_path = tmp_path / "hallo3"
+    hallo3_path.mkdir()
+    snapshot_path = tmp_path / "hf-cache" / "snapshot"
+    snapshot_path.mkdir(parents=True)
+    downloads = []
+
+    def snapshot_download(**kwargs):
+        downloads.append(kwargs["repo_id"])
+        return str(snapshot_path)
+
+    monkeypatch.setattr(handler, "HALLO3_PATH", hallo3_path)
+    monkeypatch.setattr(handler, "LEGACY_MODELS_DIR", tmp_path / "hallo3-models" / "pretrained_models")
+    monkeypatch.setattr(handler, "models_downloaded", False)
+    monkeypatch.setitem(
+        sys.modules, "huggingface_hub", types.SimpleNamespace(snapshot_download=snapshot_download)
+    )
+    return hallo3_path / "pretrained_models", snapshot_path, downloads
+
+
+def test_download_links_hf_cache_snapshot(model_dirs):
+    hallo3_models, snapshot_path, downloads = model_dirs
+
+    handler.download_models()
+    assert downloads == ["fudan-generative-ai/hallo3"]
+    assert hallo3_models.resolve() == snapshot_path.resolve()
+
+
+def test_download_skipped_for_models_in_image(model_dirs):
+    hallo3_models, _, downloads = model_dirs
+    hallo3_models.mkdir()
+
+    handler.download_models()
+    assert downloads == []
+    assert not hallo3_models.is_symlink()
+
+
+def test_download_reuses_previous_volume_layout(model_dirs):
+    hallo3_models, _, downloads = model_dirs
+    handler.LEGACY_MODELS_DIR.mkdir(parents=True)
+    (handler.LEGACY_MODELS_DIR / ".download_complete").touch()
+
+    handler.download_models()
+    assert downloads == []
+    assert hallo3_models.resolve() == handler.LEGACY_MODELS_DIR.resolve()
+
+
+def test_uses_pybase64_when_installed():
+    assert handler.b64codec is (pybase64 or base64)